@@ -1,19 +1,32 @@
 import math
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers
 from tensorflow.keras import backend as K
 
 
+def positionTable(length, embedding_size):
+    """Sinusoidal encodings of the positions 1..length, sin on even and cos on odd features."""
+    j = np.arange(1, length + 1, dtype=np.float64)[:, None]
+    i = np.arange(embedding_size)
+    angle = j / np.power(10000.0, (i - i % 2) / embedding_size)
+    return np.where(i % 2 == 0, np.sin(angle), np.cos(angle)).astype(np.float32)
+
+
 class PositionLayer(tf.keras.layers.Layer):
-    def __init__(self, embedding_size, **kwargs):
+    def __init__(self, embedding_size, max_length=256, **kwargs):
         self.embedding_size = embedding_size
+        self.max_length = max_length
+        self.table = None
         super(PositionLayer, self).__init__(**kwargs)
 
     def build(self, input_shape):
+        # precomputed encodings, longer sequences fall back to computing them in the graph
+        self.table = K.constant(positionTable(self.max_length, self.embedding_size))
         super(PositionLayer, self).build(input_shape)
 
-    def call(self, x):
-        mask = K.expand_dims(K.cast(K.arange(start=0, stop=K.shape(x)[1] + 1), 'float32'), axis=-1)
+    def encodings(self, length):
+        mask = K.expand_dims(K.cast(K.arange(start=0, stop=length + 1), 'float32'), axis=-1)
         bins = K.expand_dims(K.cast(K.arange(self.embedding_size // 2) * 2, 'float32'), axis=0)
 
         evens = K.dot(mask, 1.0 / K.pow(10000.0, bins / self.embedding_size))
@@ -22,10 +35,16 @@ class PositionLayer(tf.keras.layers.Layer):
         evens = K.sin(evens)[1:, :]
         odds = K.cos(odds)[1:, :]
 
-        pos = K.reshape(K.stack([evens, odds], axis=2), (-1, K.shape(x)[1], self.embedding_size))
-        y = K.expand_dims(x, axis=-1)
+        return K.reshape(K.stack([evens, odds], axis=2), (length, self.embedding_size))
+
+    def call(self, x):
+        length = K.shape(x)[1]
+        pos = tf.cond(length <= self.max_length,
+                      lambda: self.table[:length],
+                      lambda: self.encodings(length))
 
-        return pos * y
+        y = K.expand_dims(x, axis=-1)
+        return K.expand_dims(pos, axis=0) * y
 
 
 class MaskLayerLeft(tf.keras.layers.Layer):
@@ -121,15 +140,88 @@ class SelfLayer(tf.keras.layers.Layer):
         super(SelfLayer, self).build(input_shape)
 
     def call(self, inputs):
+        # keys after the last one unmasked anywhere in the batch get zero weight,
+        # so they are not computed at all
+        mask = inputs[3]
+        last = tf.reduce_max(mask, axis=[0, 1])
+        length = tf.reduce_max(tf.cast(last > 0, 'int32') * tf.range(1, tf.shape(last)[0] + 1))
+        mask = mask[:, :, :length]
+
         Q = tf.tensordot(inputs[0], self.Q, axes=[[2], [0]])
-        K = tf.tensordot(inputs[1], self.K, axes=[[2], [0]])
-        V = tf.tensordot(inputs[2], self.V, axes=[[2], [0]])
+        K = tf.tensordot(inputs[1][:, :length], self.K, axes=[[2], [0]])
+        V = tf.tensordot(inputs[2][:, :length], self.V, axes=[[2], [0]])
 
         A = tf.keras.backend.batch_dot(Q, tf.transpose(K, (0, 2, 1)))
         A = A / self.denom
 
-        A = tf.exp(A) * inputs[3]
+        A = tf.exp(A) * mask
         A = A / tf.reshape(tf.reduce_sum(A, axis=2), (-1, tf.shape(inputs[0])[1], 1))
 
         A = layers.Dropout(rate=0.1)(A)
         return tf.keras.backend.batch_dot(A, V)
+
+
+class MultiHeadSelfLayer(tf.keras.layers.Layer):
+    """n_heads SelfLayers computed at once, the same as concatenating their outputs.
+
+    The weights are kept per head in the order of the SelfLayers (K, V, Q of every head),
+    so set_weights takes the weights of models built with SelfLayers unchanged. They are
+    packed into one projection matrix in the graph and the heads are a batch axis of the attention.
+    """
+
+    def __init__(self, embedding_size, key_size, n_heads, **kwargs):
+        self.embedding_size = embedding_size
+        self.key_size = key_size
+        self.n_heads = n_heads
+        self.denom = math.sqrt(embedding_size)
+        self.K, self.V, self.Q = [], [], []
+        super(MultiHeadSelfLayer, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        for i in range(self.n_heads):
+            for name, heads in [("K", self.K), ("V", self.V), ("Q", self.Q)]:
+                heads.append(self.add_weight(shape=(self.embedding_size, self.key_size),
+                                             name=name + "_" + str(i), trainable=True,
+                                             initializer='glorot_uniform'))
+        super(MultiHeadSelfLayer, self).build(input_shape)
+
+    def split(self, x):
+        # (batch, length, heads * key) -> (batch, heads, length, key)
+        x = tf.reshape(x, [tf.shape(x)[0], tf.shape(x)[1], self.n_heads, self.key_size])
+        return tf.transpose(x, (0, 2, 1, 3))
+
+    def call(self, inputs):
+        # keys after the last one unmasked anywhere in the batch get zero weight
+        mask = inputs[3]
+        last = tf.reduce_max(mask, axis=[0, 1])
+        length = tf.reduce_max(tf.cast(last > 0, 'int32') * tf.range(1, tf.shape(last)[0] + 1))
+        mask = mask[:, :, :length]
+
+        size = self.n_heads * self.key_size
+        if inputs[0] is inputs[1] and inputs[1] is inputs[2]:
+            QKV = tf.tensordot(inputs[0], K.concatenate(self.Q + self.K + self.V, axis=1), axes=[[2], [0]])
+            Q, KV = QKV[:, :, :size], QKV[:, :length, size:]
+        else:
+            # attention to another sequence, e.g. of the decoder to the encoder
+            Q = tf.tensordot(inputs[0], K.concatenate(self.Q, axis=1), axes=[[2], [0]])
+            if inputs[1] is inputs[2]:
+                KV = tf.tensordot(inputs[1][:, :length], K.concatenate(self.K + self.V, axis=1), axes=[[2], [0]])
+            else:
+                KV = tf.concat([tf.tensordot(inputs[1][:, :length], K.concatenate(self.K, axis=1), axes=[[2], [0]]),
+                                tf.tensordot(inputs[2][:, :length], K.concatenate(self.V, axis=1), axes=[[2], [0]])],
+                               axis=2)
+
+        Q = self.split(Q)
+        Kt = tf.transpose(self.split(KV[:, :, :size]), (0, 1, 3, 2))
+        V = self.split(KV[:, :, size:])
+
+        A = tf.matmul(Q, Kt) / self.denom
+
+        A = tf.exp(A) * K.expand_dims(mask, axis=1)
+        A = A / tf.reduce_sum(A, axis=3, keepdims=True)
+
+        A = layers.Dropout(rate=0.1)(A)
+
+        # (batch, heads, length, key) -> (batch, length, heads * key), the heads in order as by Concatenate
+        y = tf.transpose(tf.matmul(A, V), (0, 2, 1, 3))
+        return tf.reshape(y, [tf.shape(y)[0], tf.shape(y)[1], size])
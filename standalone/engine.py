@@ -0,0 +1,442 @@
+# Batched NumPy forward pass for the Transformer-CNN model.
+# All SMILES (e.g. every rooted SMILES of a molecule) are stacked into one
+# padded (B, L, 64) tensor and processed together with a per-row length mask.
+# Authors: Dr. Pavel Karpov, Dr. Igor V. Tetko, BIGCHEM GmbH, 2020.
+# email: carpovpv@gmail.com
+
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# the parameters are the same as for Transformer-CNN model.
+N_HIDDEN = 512
+N_HIDDEN_CNN = 512
+EMBEDDING_SIZE = 64
+KEY_SIZE = EMBEDDING_SIZE
+CONV_OFFSET = 20
+
+n_block, n_self = 3, 10
+
+KERNEL_SIZES = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 15, 20]
+NUM_FILTERS = [100, 200, 200, 200, 200, 100, 100, 100, 100, 100, 160, 160]
+
+# vocabulary
+chars = " ^#%()+-./0123456789=@ABCDEFGHIKLMNOPRSTVXYZ[\\]abcdefgilmnoprstuy$"
+vocab_size = len(chars)
+char_to_ix = {ch: i for i, ch in enumerate(chars)}
+
+
+def tokenizeBatch(smiles):
+    """Token ids padded to the longest string plus CONV_OFFSET, and the real lengths."""
+    lengths = np.array([len(s) for s in smiles], dtype=np.int32)
+    x = np.zeros((len(smiles), np.max(lengths) + CONV_OFFSET), np.int32)
+    for b, s in enumerate(smiles):
+        x[b, :lengths[b]] = [char_to_ix[c] for c in s]
+    return x, lengths
+
+
+# encodings of positions 1..n, computed once and grown when a longer SMILES shows up
+POSITION_TABLE_SIZE = 256
+positions = None
+
+
+def positionTable(n):
+    """Sinusoidal encodings of the positions 1..n, sliced from the shared table."""
+    global positions
+
+    if positions is None or positions.shape[0] < n:
+        size = max(n, POSITION_TABLE_SIZE if positions is None else 2 * positions.shape[0])
+
+        j = np.arange(1, size + 1, dtype=np.float64)[:, None]
+        i = np.arange(EMBEDDING_SIZE)
+        angle = j / np.power(10000.0, (i - i % 2) / EMBEDDING_SIZE)
+        positions = np.where(i % 2 == 0, np.sin(angle), np.cos(angle)).astype(np.float32)
+
+    return positions[:n]
+
+
+def positionalEncoding(lengths, nl):
+    """Sinusoidal encodings, zero beyond the length of each row."""
+    mask = np.arange(nl)[None, :] < lengths[:, None]
+    return positionTable(nl)[None, :, :] * mask[:, :, None]
+
+
+def layerNorm(x, gamma, beta):
+    mean = np.mean(x, axis=-1, keepdims=True)
+    std = np.std(x, axis=-1, keepdims=True)
+    return gamma * (x - mean) / (std + 1e-6) + beta
+
+
+def linear(x, w):
+    """x @ w for float32/float16 weights and for per-channel int8 weights {"q", "scale"}.
+
+    NumPy converts reduced precision weights to a float32 copy for every product, so they
+    only make the stored model and its shared pages smaller, not the GEMM faster.
+    """
+    if isinstance(w, dict):
+        return np.matmul(x, w["q"]) * w["scale"]
+    return np.matmul(x, w)
+
+
+def dequantize(w, dtype=np.float32):
+    if isinstance(w, dict):
+        return w["q"].astype(dtype) * w["scale"].astype(dtype)
+    return w.astype(dtype)
+
+
+def quantize(w, precision):
+    if precision == "float16":
+        return w.astype(np.float16)
+
+    # symmetric int8 with one scale per output channel (the last axis)
+    scale = np.max(np.abs(w), axis=tuple(range(w.ndim - 1))) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.clip(np.round(w / scale), -127, 127).astype(np.int8)
+    return {"q": q, "scale": scale.astype(np.float32)}
+
+
+PRECISIONS = ["float32", "float16", "int8"]
+
+
+def quantizeModel(model, precision="float32"):
+    """Stores the GEMM weights of a packed model as float32, float16 or per-channel int8.
+
+    Embeddings, biases and normalization weights stay float32 and all activations
+    are float32 in every mode.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("unknown precision " + str(precision) + ", use one of " + ", ".join(PRECISIONS))
+    if precision == "float32":
+        convert = lambda w: dequantize(w)
+    else:
+        convert = lambda w: quantize(dequantize(w), precision)
+
+    model = dict(model)
+    model["blocks"] = [dict(weights) for weights in model["blocks"]]
+
+    for weights in model["blocks"]:
+        weights["qkv"] = convert(weights["qkv"])
+        for key in ["dense", "conv1", "conv2"]:
+            weights[key] = (convert(weights[key][0]), weights[key][1])
+
+    model["convs"] = [(size, convert(w), bias) for size, w, bias in model["convs"]]
+    for key in ["dense", "gate", "transform", "out"]:
+        model[key] = (convert(model[key][0]), model[key][1])
+
+    return model
+
+
+def packModel(d):
+    """Repacks the positional weight list of a model into named, ready-to-use arrays.
+
+    The K, V and Q matrices of all heads of a block are stacked into one
+    (64, 3 * 640) projection, so a block needs a single GEMM for its attention inputs.
+    The Char-CNN kernels are stored in the column layout of sliding_window_view.
+    """
+    model = {"embed": d[0], "blocks": []}
+
+    for block in range(n_block):
+        base = 40 * block
+        heads = [d[base + 1 + 3 * head: base + 4 + 3 * head] for head in range(n_self)]
+
+        # d keeps K, V, Q per head; the packed order is all Q, then all K, then all V
+        qkv = np.concatenate([np.concatenate([h[2] for h in heads], axis=1),
+                              np.concatenate([h[0] for h in heads], axis=1),
+                              np.concatenate([h[1] for h in heads], axis=1)], axis=1)
+
+        model["blocks"].append({"qkv": qkv,
+                                "dense": (d[base + 31], d[base + 32]),
+                                "norm1": (d[base + 33], d[base + 34]),
+                                "conv1": (d[base + 35][0], d[base + 36]),
+                                "conv2": (d[base + 37][0], d[base + 38]),
+                                "norm2": (d[base + 39], d[base + 40])})
+
+    # (size, 64, filters) -> (64 * size, filters), matching windows of shape (64, size)
+    model["convs"] = []
+    for i, (size, filters) in enumerate(zip(KERNEL_SIZES, NUM_FILTERS)):
+        w = d[121 + 2 * i].reshape((size, EMBEDDING_SIZE, filters))
+        w = np.ascontiguousarray(np.transpose(w, (1, 0, 2)).reshape((-1, filters)))
+        model["convs"].append((size, w, d[122 + 2 * i]))
+
+    model["dense"] = (d[145], d[146])
+    model["gate"] = (d[147], d[148])
+    model["transform"] = (d[149], d[150])
+    model["out"] = (d[151], d[152])
+
+    return model
+
+
+def selfAttention(qkv, l_embed, key_mask):
+    """All heads at once: (B, L, 64) -> (B, L, 640), heads concatenated in order."""
+    nb, nl, _ = l_embed.shape
+
+    # (B, L, 3 * 640) -> 3 x (B, heads, L, 64)
+    qkv = linear(l_embed, qkv).reshape((nb, nl, 3, n_self, KEY_SIZE))
+    q, k, v = np.transpose(qkv, (2, 0, 3, 1, 4))
+
+    a = np.matmul(q, np.swapaxes(k, 2, 3)) / math.sqrt(EMBEDDING_SIZE)
+
+    # masked keys get exactly zero weight, the rest is a max-subtracted softmax
+    a = np.where(key_mask[:, None, None, :] > 0, a, -np.inf)
+    a = np.exp(a - np.max(a, axis=-1, keepdims=True))
+    a = a / np.sum(a, axis=-1, keepdims=True)
+
+    return np.transpose(np.matmul(a, v), (0, 2, 1, 3)).reshape((nb, nl, n_self * KEY_SIZE))
+
+
+def encoderBlock(weights, l_embed, key_mask):
+    sa = selfAttention(weights["qkv"], l_embed, key_mask)
+
+    # TimeDistributed Dense with the residual connection
+    l_add = linear(sa, weights["dense"][0]) + weights["dense"][1] + l_embed
+    l_norm = layerNorm(l_add, *weights["norm1"])
+
+    # position-wise 1D convolutions, the first one with relu activation
+    l_c1 = linear(l_norm, weights["conv1"][0]) + weights["conv1"][1]
+    l_c1[l_c1 < 0] = 0
+    l_c2 = linear(l_c1, weights["conv2"][0]) + weights["conv2"][1]
+
+    return layerNorm(l_norm + l_c2, *weights["norm2"])
+
+
+def encode(model, x, lengths):
+    """Transformer encoder over a (B, L) batch of token ids, returns (B, L, 64).
+
+    Only the real positions and one padding position are computed. Every padding
+    token of a row has the same input (a blank without positional encoding) and is
+    masked as a key, so all of them get the output of that one position, which is
+    copied over the padding at the boundary to the Char-CNN.
+    """
+    nb, nl = x.shape
+    n = min(np.max(lengths) + 1, nl)
+    real = np.arange(n)[None, :] < lengths[:, None]
+
+    l_embed = model["embed"][x[:, :n]] + positionalEncoding(lengths, n)
+    for weights in model["blocks"]:
+        l_embed = encoderBlock(weights, l_embed, real.astype(np.float32))
+
+    pad = l_embed[np.arange(nb), np.minimum(lengths, n - 1)]
+
+    l_encoder = np.empty((nb, nl, EMBEDDING_SIZE), dtype=l_embed.dtype)
+    l_encoder[:] = pad[:, None, :]
+    l_encoder[:, :n] = np.where(real[:, :, None], l_embed, pad[:, None, :])
+    return l_encoder
+
+
+def charCNN(model, l_embed, lengths):
+    """Valid convolutions with relu and max pooling over the positions of each row.
+
+    Every kernel is a single GEMM over the im2col view of the encoder output.
+    Returns the pooled features and, for every kernel, the argmax positions.
+    Windows beyond the CONV_OFFSET padding of a row are zeroed, so they never win
+    the max over the (non-negative) relu outputs.
+    """
+    nb, nl, _ = l_embed.shape
+
+    pooled, maxes = [], []
+    for size, w, bias in model["convs"]:
+        n = nl - size + 1
+
+        cols = sliding_window_view(l_embed, size, axis=1).reshape((nb, n, -1))
+        lc = linear(cols, w) + bias
+        np.maximum(lc, 0.0, out=lc)
+
+        valid = np.arange(n)[None, :] < (lengths + CONV_OFFSET - size + 1)[:, None]
+        lc *= valid[:, :, None]
+
+        ind = np.argmax(lc, axis=1)
+        maxes.append(ind)
+        pooled.append(np.take_along_axis(lc, ind[:, None, :], axis=1)[:, 0])
+
+    return np.concatenate(pooled, axis=1), maxes
+
+
+def forward(model, x, lengths):
+    """Full forward pass; returns the raw model output (B, 1) and the intermediates for LRP."""
+    l_encoder = encode(model, x, lengths)
+    l_cnn, maxes = charCNN(model, l_encoder, lengths)
+
+    l_dense = linear(l_cnn, model["dense"][0]) + model["dense"][1]
+    l_dense[l_dense < 0] = 0.0
+
+    # highway
+    transform_gate = 1.0 / (1.0 + np.exp(-linear(l_dense, model["gate"][0]) - model["gate"][1]))
+    carry_gate = 1.0 - transform_gate
+
+    transformed_data = linear(l_dense, model["transform"][0]) + model["transform"][1]
+    transformed_data[transformed_data < 0] = 0.0
+
+    transformed_gated = transform_gate * transformed_data
+    identity_gated = carry_gate * l_dense
+    l_highway = transformed_gated + identity_gated
+
+    # the last layer
+    l_out = linear(l_highway, model["out"][0]) + model["out"][1]
+
+    trace = {"encoder": l_encoder, "maxes": maxes, "cnn": l_cnn, "dense": l_dense,
+             "transformed_gated": transformed_gated, "identity_gated": identity_gated,
+             "highway": l_highway}
+    return l_out, trace
+
+
+# Layer-wise relevance propagation, batched over SMILES, positions and windows.
+
+def calcLRPDenseOut(l_previous, w, l_next):
+    # (B, n_in) -> (B, n_out, n_in) contributions of every input to every output
+    zij = np.transpose(dequantize(w[0], l_previous.dtype))[None, :, :] * l_previous[:, None, :]
+    zij = zij / (np.sum(zij, axis=2, keepdims=True) + w[1][None, :, None])
+    return np.matmul(l_next[:, None, :], zij)[:, 0]
+
+
+def calcLRPDenseInner(l_previous, w, l_next, dtype=np.float32):
+    # R_i = x_i * sum_j w_ij * R_j / z_j, for any leading dimensions of l_previous
+    x = l_previous.astype(dtype)
+    w0 = dequantize(w[0], dtype)
+
+    z = np.matmul(x, w0) + w[1] + 1e-32
+    return x * np.matmul(l_next / z, np.transpose(w0))
+
+
+def calcLRPAddition(l_first, l_second, l_sum, R):
+    result = np.copy(l_sum)
+
+    # to avoid division by zero error if both values are zero
+    result[result == 0.0] = 1.0e32
+
+    f = l_first / result
+
+    r_first = R * f
+    r_second = R - r_first
+
+    return r_first, r_second
+
+
+def calcLRPPool(n, inds, R):
+    # (B, filters) relevance back to the pooled positions, (B, n, filters)
+    demax = np.zeros((R.shape[0], n, R.shape[1]), dtype=R.dtype)
+    np.add.at(demax, (np.arange(R.shape[0])[:, None], inds, np.arange(R.shape[1])[None, :]), R)
+    return demax
+
+
+def visitedWindows(lengths, size):
+    # Windows of every row the relevance is propagated through. Larger kernels skip
+    # the last two windows of a row; the relevance pooled there is dropped and the
+    # rest is scaled back to the pooled total.
+    if size == 1:
+        return lengths + CONV_OFFSET
+    return lengths + CONV_OFFSET - size - 1
+
+
+def calcLRPConv(l_prev, lengths, conv, l_out, dtype=np.float32):
+    size, w, bias = conv
+    nb, nl, _ = l_prev.shape
+    n = nl - size + 1
+
+    visited = np.arange(n)[None, :] < visitedWindows(lengths, size)[:, None]
+
+    cols = sliding_window_view(l_prev, size, axis=1).reshape((nb, n, -1))
+    R = calcLRPDenseInner(cols, [w, bias], l_out * visited[:, :, None], dtype)
+
+    # overlapping windows, (B, n, 64, size) -> (B, L, 64)
+    R = np.swapaxes(R.reshape((nb, n, EMBEDDING_SIZE, size)), 2, 3)
+    y = np.zeros(l_prev.shape, dtype=dtype)
+    np.add.at(y, (np.arange(nb)[:, None, None], np.arange(n)[None, :, None] + np.arange(size)[None, None, :]), R)
+
+    if size > 1:
+        # a row without visited windows, a short string for a large kernel, gets no relevance here
+        total = np.sum(y, axis=(1, 2))
+        scale = np.divide(np.sum(l_out, axis=(1, 2)), total, out=np.zeros_like(total), where=total != 0)
+        y = y * scale[:, None, None]
+
+    return y
+
+
+def calcLRPConvRoot(l_prev, lengths, conv, R, inds, dtype=np.float32):
+    # Relevance of the first position only. It is covered by the first window alone,
+    # and only the filters pooled from that window put relevance into it. The total
+    # needed for the normalization of larger kernels is summed per filter at its
+    # pooled window, so no other window is expanded.
+    size, w, bias = conv
+    w = dequantize(w, dtype)
+    nb = l_prev.shape[0]
+
+    used = inds < visitedWindows(lengths, size)[:, None]
+
+    # (B, filters, 64 * size) pooled window of every filter
+    x_ = sliding_window_view(l_prev, size, axis=1)[np.arange(nb)[:, None], inds]
+    x_ = x_.reshape((nb, inds.shape[1], -1)).astype(dtype)
+
+    zj = np.sum(x_ * np.transpose(w)[None, :, :], axis=2)
+    z = zj + bias + 1e-32
+
+    total = np.sum(np.where(used, R * zj / z, 0.0), axis=1)
+
+    first = np.where(used & (inds == 0), R / z, 0.0)
+    w0 = w.reshape((EMBEDDING_SIZE, size, -1))[:, 0, :]
+    y = l_prev[:, 0].astype(dtype) * np.matmul(first, np.transpose(w0))
+
+    if size == 1:
+        return y, total
+
+    # as in calcLRPConv, the relevance of rows without visited windows is not propagated
+    R_sum = np.where(total != 0, np.sum(R, axis=1), 0.0)
+    scale = np.divide(R_sum, total, out=np.zeros_like(total), where=total != 0)
+    return y * scale[:, None], R_sum
+
+
+def explain(model, trace, l_out, rootOnly=False, dtype=np.float32, check=None):
+    """Propagates the (B, 1) outputs back to the tokens of every SMILES.
+
+    Returns per-token scores (B, L), or with rootOnly the (B, 1) relevance of the
+    first token, and the part of the output not assigned to any token (B,).
+    check(label, relevance, reference) is called after every layer.
+    """
+    if check is None:
+        check = lambda label, x, val: None
+
+    l_embed = trace["encoder"]
+    lengths = trace["lengths"]
+    l_highway = trace["highway"]
+    l_out = l_out.astype(dtype)
+
+    R_highway = calcLRPDenseOut(l_highway, model["out"], l_out)
+    check("HighWay Output:", R_highway, l_out)
+
+    R_identity, R_transformed_gated = calcLRPAddition(trace["identity_gated"], trace["transformed_gated"],
+                                                      l_highway, R_highway)
+
+    R_dense_high3 = calcLRPDenseInner(trace["dense"], model["transform"], R_transformed_gated, dtype)
+    R_input_highway = R_identity + R_dense_high3
+    check("Input HighWay:", R_input_highway, R_highway)
+
+    R_cnn = calcLRPDenseInner(trace["cnn"], model["dense"], R_input_highway, dtype)
+
+    bounds = np.cumsum([0] + NUM_FILTERS)
+    R_pool = [R_cnn[:, bounds[i]:bounds[i + 1]] for i in range(len(KERNEL_SIZES))]
+    check("DeMaxPool:", R_pool, R_input_highway)
+
+    if rootOnly:
+        R_root = np.zeros((l_embed.shape[0], EMBEDDING_SIZE), dtype=dtype)
+        R_total = np.zeros(l_embed.shape[0], dtype=dtype)
+        for i, conv in enumerate(model["convs"]):
+            R_conv, R_sum = calcLRPConvRoot(l_embed, lengths, conv, R_pool[i], trace["maxes"][i], dtype)
+            check("  Conv" + str(conv[0]) + ":", R_sum, R_pool[i])
+            R_root = R_root + R_conv
+            R_total = R_total + R_sum
+
+        check("Deconvolution:", R_total, l_out)
+        return np.sum(R_root, axis=1, keepdims=True), np.sum(l_out, axis=1) - R_total
+
+    R_cnn = np.zeros(l_embed.shape, dtype=dtype)
+    for i, conv in enumerate(model["convs"]):
+        # Increase the dimension pulling the relevance to a maximum descriptor.
+        demax = calcLRPPool(l_embed.shape[1] - conv[0] + 1, trace["maxes"][i], R_pool[i])
+        R_conv = calcLRPConv(l_embed, lengths, conv, demax, dtype)
+        check("  Conv" + str(conv[0]) + ":", R_conv, demax)
+        R_cnn = R_cnn + R_conv
+
+    check("Deconvolution:", R_cnn, l_out)
+
+    scores = np.sum(R_cnn, axis=2)
+    return scores, np.sum(l_out, axis=1) - np.sum(scores, axis=1)
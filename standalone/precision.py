@@ -0,0 +1,44 @@
+# Accuracy of the reduced precision modes against the float32 model.
+# Usage: python3 precision.py models/solubility.pickle ../data/solubility.csv
+
+import csv
+import sys
+import time
+
+import numpy as np
+from rdkit.Chem import MolFromSmiles, MolToSmiles
+
+from engine import PRECISIONS
+from ochem import Predictor
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: ", sys.argv[0], "model.pickle", "data.csv")
+        sys.exit(0)
+
+    smiles = []
+    rows = csv.reader(open(sys.argv[2], "r"))
+    next(rows)
+    for row in rows:
+        m = MolFromSmiles(row[0])
+        if m is not None:
+            smiles.append(MolToSmiles(m, isomericSmiles=False))
+
+    print("Molecules: ", len(smiles))
+    print("{:10}|{:>15}  |{:>15}  |{:>15}  |{:>10}".format("Precision", "Max abs delta", "Mean abs delta",
+                                                         "Max rel delta", "Time, s"))
+
+    reference = None
+    for precision in PRECISIONS:
+        predictor = Predictor(sys.argv[1], precision=precision)
+
+        start = time.time()
+        vals = predictor.predict(smiles)
+        spent = time.time() - start
+
+        if reference is None:
+            reference = vals
+
+        delta = np.abs(vals - reference)
+        print("{:10}|{:15.5g}  |{:15.5g}  |{:15.5g}  |{:10.2f}".format(
+            precision, np.max(delta), np.mean(delta), np.max(delta / np.maximum(np.abs(reference), 1e-12)), spent))
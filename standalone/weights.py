@@ -0,0 +1,105 @@
+# Memory-mapped weight files for the standalone Transformer-CNN models.
+# Usage: python3 weights.py models/solubility.pickle models/solubility.tcnn [float32|float16|int8]
+#
+# The file is a JSON header followed by raw, 64-byte aligned tensors. Opening it
+# maps the file read-only, so all processes using the same model share the pages
+# of the OS cache and loading costs only the header. Models can be stored with
+# float16 or per-channel int8 GEMM weights, see engine.quantizeModel.
+
+import json
+import pickle
+import struct
+import sys
+
+import numpy as np
+
+from engine import packModel, quantizeModel
+
+MAGIC = b"TCNNW001"
+ALIGN = 64
+
+
+def flattenTensors(tree, tensors):
+    # replaces every array by a reference into the tensors list
+    if isinstance(tree, dict):
+        return {key: flattenTensors(value, tensors) for key, value in tree.items()}
+    if isinstance(tree, (list, tuple)):
+        return [flattenTensors(value, tensors) for value in tree]
+    if isinstance(tree, np.ndarray):
+        tensors.append(np.ascontiguousarray(tree))
+        return {"tensor": len(tensors) - 1}
+    return tree
+
+
+def unflattenTensors(tree, tensors):
+    if isinstance(tree, dict):
+        if "tensor" in tree:
+            return tensors[tree["tensor"]]
+        return {key: unflattenTensors(value, tensors) for key, value in tree.items()}
+    if isinstance(tree, list):
+        return [unflattenTensors(value, tensors) for value in tree]
+    return tree
+
+
+def saveTensors(fname, tree, info=None):
+    """Writes a nested dict/list of arrays and plain values to a weight file."""
+    tensors = []
+    tree = flattenTensors(tree, tensors)
+
+    entries = []
+    offset = 0
+    for t in tensors:
+        entries.append({"dtype": t.dtype.str, "shape": list(t.shape), "offset": offset})
+        offset += -(-t.nbytes // ALIGN) * ALIGN
+
+    header = json.dumps({"info": info, "tree": tree, "tensors": entries}).encode("utf-8")
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    with open(fname, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for entry, t in zip(entries, tensors):
+            f.seek(start + entry["offset"])
+            f.write(t.tobytes())
+        f.truncate(start + offset)
+
+
+def loadTensors(fname):
+    """Opens a weight file; the arrays are read-only views of one shared memory map."""
+    with open(fname, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(fname + " is not a Transformer-CNN weight file")
+        size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(size).decode("utf-8"))
+
+    start = -(-(len(MAGIC) + 8 + size) // ALIGN) * ALIGN
+    data = np.memmap(fname, dtype=np.uint8, mode="r")
+
+    tensors = []
+    for entry in header["tensors"]:
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        offset = start + entry["offset"]
+        tensors.append(data[offset:offset + count * dtype.itemsize].view(dtype).reshape(entry["shape"]))
+
+    return header["info"], unflattenTensors(header["tree"], tensors)
+
+
+def isWeightFile(fname):
+    with open(fname, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def convert(fname_in, fname_out, precision="float32"):
+    """Converts a pickled standalone model to a weight file."""
+    info, d = pickle.load(open(fname_in, "rb"))
+    saveTensors(fname_out, quantizeModel(packModel(d), precision), info)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4]:
+        print("Usage: ", sys.argv[0], "model.pickle", "output.tcnn", "[float32|float16|int8]")
+        sys.exit(0)
+
+    convert(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else "float32")
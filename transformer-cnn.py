@@ -1,12 +1,19 @@
 import configparser
 import csv
+import hashlib
+import io
 import math
+import multiprocessing
 import os
 import pickle
 import random
 import shutil
 import sys
 import tarfile
+import tempfile
+import threading
+import time
+from queue import Queue
 
 import h5py
 import numpy as np
@@ -18,7 +25,7 @@ from tensorflow.keras.callbacks import ModelCheckpoint
 
 from layers import PositionLayer, MaskLayerLeft, \
     MaskLayerRight, MaskLayerTriangular, \
-    SelfLayer, LayerNormalization
+    MultiHeadSelfLayer, LayerNormalization
 
 version = 4
 print("Version: ", version)
@@ -42,6 +49,7 @@ def getConfig(section, attribute, default=""):
 
 TRAIN = getConfig("Task", "train_mode")
 MODEL_FILE = getConfig("Task", "model_file")
+MODEL_FILES = [f.strip() for f in MODEL_FILE.split(",") if f.strip()]
 TRAIN_FILE = getConfig("Task", "train_data_file")
 APPLY_FILE = getConfig("Task", "apply_data_file", "train.csv")
 RESULT_FILE = getConfig("Task", "result_file", "results.csv")
@@ -55,6 +63,19 @@ AVERAGING = int(getConfig("Details", "averaging", "5"))
 FIXED_LEARNING_RATE = getConfig("Details", "fixed-learning-rate", "False")
 RETRAIN = getConfig("Details", "retrain", "False")
 CHIRALITY = getConfig("Details", "chirality", "True")
+NUM_WORKERS = int(getConfig("Details", "n_workers", str(os.cpu_count() or 1)))
+DATASET_CACHE = getConfig("Details", "dataset_cache", "")
+BUCKET_BOUNDARIES = [int(b) for b in getConfig("Details", "bucket_boundaries", "").split(",") if b.strip()]
+BATCH_TOKENS = int(getConfig("Details", "batch_tokens", "0"))
+BUCKETING = len(BUCKET_BOUNDARIES) > 0 or BATCH_TOKENS > 0
+ENCODER_BATCH_SIZE = int(getConfig("Details", "encoder_batch_size", "256"))
+ENCODER_BATCH_TOKENS = int(getConfig("Details", "encoder_batch_tokens", "0"))
+ENCODER_CACHE = getConfig("Details", "encoder_cache", "")
+APPLY_CHUNK = int(getConfig("Details", "apply_chunk", "10000"))
+N_SHARDS = int(getConfig("Details", "n_shards", "1"))
+INTRA_OP_THREADS = int(getConfig("Details", "intra_op_threads", "0"))
+DESCRIPTOR_STORE = getConfig("Details", "descriptor_store", "")
+DESCRIPTOR_DTYPE = getConfig("Details", "descriptor_dtype", "float32")
 
 FIRST_LINE = getConfig("Details", "first-line", "True")
 if FIRST_LINE == "True":
@@ -74,16 +95,20 @@ n_block, n_self = 3, 10
 
 # our vocabulary
 chars = " ^#%()+-./0123456789=@ABCDEFGHIKLMNOPRSTVXYZ[\\]abcdefgilmnoprstuy$"
-g_chars = set(chars)
 vocab_size = len(chars)
 
 char_to_ix = {ch: i for i, ch in enumerate(chars)}
 ix_to_char = {i: ch for i, ch in enumerate(chars)}
 
+# token id of every byte, -1 for bytes outside of our vocabulary
+char_lookup = np.full(256, -1, dtype=np.int16)
+char_lookup[np.frombuffer(chars.encode(), dtype=np.uint8)] = np.arange(vocab_size)
+
 print("Using: ", DEVICE)
 print("Set seed to ", SEED)
 
-config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)
+config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False,
+                        intra_op_parallelism_threads=INTRA_OP_THREADS)
 config.gpu_options.allow_growth = True
 tf.logging.set_verbosity(tf.logging.ERROR)
 K.set_session(tf.Session(config=config))
@@ -113,6 +138,54 @@ class suppress_stderr(object):
             os.close(fd)
 
 
+def inVocabulary(smiles):
+    return bool(np.all(char_lookup[np.frombuffer(smiles.encode(), dtype=np.uint8)] >= 0))
+
+
+class RaggedSmiles(object):
+    """Token ids of many SMILES strings stored back to back, with their property values and masks."""
+
+    def __init__(self, tokens, offsets, values, masks):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.values = values
+        self.masks = masks
+        self.lengths = np.diff(offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @staticmethod
+    def tokenize(smiles):
+        """Token ids and offsets of all strings in one pass, and which of them are in the vocabulary."""
+        raw = [s.encode() for s in smiles]
+        offsets = np.concatenate([[0], np.cumsum([len(r) for r in raw], dtype=np.int64)])
+        ids = char_lookup[np.frombuffer(b"".join(raw), dtype=np.uint8)]
+
+        bad = np.concatenate([[0], np.cumsum(ids < 0)])
+        return ids, offsets, bad[offsets[1:]] == bad[offsets[:-1]]
+
+    @classmethod
+    def fromStrings(cls, smiles, values, masks):
+        """Tokenized strings; the ones with symbols outside the vocabulary are dropped.
+
+        Returns the data and a boolean array marking the strings that were kept.
+        """
+        ids, offsets, valid = cls.tokenize(smiles)
+        if not np.all(valid):
+            smiles = [s for s, v in zip(smiles, valid) if v]
+            ids, offsets, _ = cls.tokenize(smiles)
+            values, masks = values[valid], masks[valid]
+
+        return cls(ids.astype(np.uint8), offsets, values, masks), valid
+
+    def subset(self, inds):
+        lengths = self.lengths[inds]
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        positions = np.repeat(self.offsets[inds] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedSmiles(self.tokens[positions], offsets, self.values[inds], self.masks[inds])
+
+
 def findBoundaries(DS):
     for prop in props:
 
@@ -143,20 +216,111 @@ def findBoundaries(DS):
             props[prop].extend(["classification"])
 
 
+remover = None
+
+# encoder -> EncoderCache
+encoderCaches = {}
+
+
+def initWorker(silence=True):
+    # RDKit complains to stderr about many molecules, silence it once for the whole worker
+    global remover
+    remover = SaltRemover.SaltRemover()
+    if silence:
+        os.dup2(os.open(os.devnull, os.O_RDWR), 2)
+
+
+def augmentSmiles(job):
+    """RDKit work-up of one molecule, returns its SMILES strings and the canonization pairs.
+
+    The random generator is seeded per molecule, so the result does not depend on
+    how the molecules are distributed among workers.
+    """
+    ind, mol = job
+    rng = np.random.RandomState([SEED, ind])
+
+    arr = []
+    pairs = []
+    canon = ""
+
+    try:
+        if CANONIZE == 'True':
+            m = MolFromSmiles(mol)
+            m = remover.StripMol(m)
+
+            if m is not None:
+                canon = MolToSmiles(m)
+
+            if m is not None and m.GetNumAtoms() > 0:
+                for step in range(10):
+                    rsm = MolToSmiles(m, rootedAtAtom=rng.randint(0, m.GetNumAtoms()), canonical=False)
+                    arr.append(rsm)
+                    if RETRAIN == "True" and canon != "":
+                        pairs.append([rsm, canon])
+            else:
+                arr.append(mol)
+
+                if RETRAIN == "True" and canon != "":
+                    pairs.append([mol, canon])
+
+        else:
+
+            arr.append(mol)
+            m = MolFromSmiles(mol)
+            if m is not None:
+                canon = MolToSmiles(m)
+
+            if RETRAIN == "True" and canon != "":
+                pairs.append([mol, canon])
+
+    except:
+        arr.append(mol)
+
+    # unique strings in the order of generation
+    return list(dict.fromkeys(arr)), pairs
+
+
+def mapMolecules(func, jobs):
+    """func over all jobs, in input order, on NUM_WORKERS processes."""
+    if NUM_WORKERS <= 1 or len(jobs) < 2:
+        with suppress_stderr():
+            initWorker(False)
+            return [func(job) for job in jobs]
+
+    # fork: the workers share the parsed config and do not import TensorFlow again
+    with multiprocessing.get_context("fork").Pool(NUM_WORKERS, initializer=initWorker) as pool:
+        return pool.map(func, jobs, chunksize=max(1, min(1024, len(jobs) // (4 * NUM_WORKERS))))
+
+
+def applySmiles(job):
+    """Random SMILES of one molecule for the prognosis, seeded by its row in the input file."""
+    ind, mol = job
+    if not inVocabulary(mol):
+        return []
+
+    rng = np.random.RandomState([SEED, ind])
+    arr = []
+    try:
+        m = MolFromSmiles(mol)
+        m = remover.StripMol(m)
+        if m is not None and m.GetNumAtoms() > 0:
+            for step in range(10):
+                arr.append(MolToSmiles(m, rootedAtAtom=rng.randint(0, m.GetNumAtoms()), canonical=False))
+        else:
+            arr.append(mol)
+    except:
+        arr.append(mol)
+    return arr
+
+
 def analyzeDescrFile(fname):
     first_row = FIRST_LINE
 
-    DS = []
+    rows = []
     ind_mol = 0
 
-    remover = SaltRemover.SaltRemover()
-
-    line = 0
     for row in csv.reader(open(fname, "r")):
 
-        # if line > 100: break
-        # line = line + 1
-
         if first_row:
             first_row = False
             j = 0
@@ -174,47 +338,16 @@ def analyzeDescrFile(fname):
         mol = row[ind_mol].strip()
 
         # remove molecules with symbols not in our vocabulary
-        g_mol = set(mol)
-        g_left = g_mol - g_chars
-        if len(g_left) > 0: continue
-
-        arr = []
-        canon = ""
+        if not inVocabulary(mol): continue
 
-        try:
-            if CANONIZE == 'True':
-                with suppress_stderr():
-                    m = MolFromSmiles(mol)
-                    m = remover.StripMol(m)
-
-                    if m is not None:
-                        canon = MolToSmiles(m)
-
-                    if m is not None and m.GetNumAtoms() > 0:
-                        for step in range(10):
-                            rsm = MolToSmiles(m, rootedAtAtom=np.random.randint(0, m.GetNumAtoms()),
-                                                   canonical=False)
-                            arr.append(rsm)
-                            if RETRAIN == "True" and canon != "":
-                                canon_pairs.append([rsm, canon])
-                    else:
-                        arr.append(mol)
+        rows.append(row)
 
-                        if RETRAIN == "True" and canon != "":
-                            canon_pairs.append([mol, canon])
-
-            else:
-
-                arr.append(mol)
-                m = MolFromSmiles(mol)
-                if m is not None:
-                    canon = MolToSmiles(m)
+    print("Preparing SMILES on", NUM_WORKERS, "workers...")
+    augmented = mapMolecules(augmentSmiles, [(i, row[ind_mol].strip()) for i, row in enumerate(rows)])
 
-                if RETRAIN == "True" and canon != "":
-                    canon_pairs.append([mol, canon])
-
-        except:
-            arr.append(mol)
+    DS = []
+    for row, (arr, pairs) in zip(rows, augmented):
+        canon_pairs.extend(pairs)
 
         vals = np.zeros(len(props), dtype=np.float32)
         mask = np.zeros(len(props), dtype=np.int8)
@@ -230,74 +363,423 @@ def analyzeDescrFile(fname):
                 mask[idx] = 1
             vals[idx] = val
 
-        arr = list(set(arr))
         for step in range(len(arr)):
             DS.append([arr[step], np.copy(vals), mask])
 
     findBoundaries(DS)
 
+    # RDKit may write symbols the input did not have, such strings are left out
+    DS, valid = RaggedSmiles.fromStrings([d[0] for d in DS], np.array([d[1] for d in DS], dtype=np.float32),
+                                         np.array([d[2] for d in DS], dtype=np.int8))
+    if not np.all(valid):
+        print("Skipped", np.sum(~valid), "generated SMILES with symbols not in the vocabulary")
+
     return DS
 
 
-def gen_data(data):
-    batch_size = len(data)
+def datasetKey(fname):
+    # everything analyzeDescrFile depends on: the file itself and the settings below
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    h.update(repr(["dataset-v2", CANONIZE, RETRAIN, SEED, FIRST_LINE]).encode())
+    return h.hexdigest()
 
-    # search for max lengths
-    nl = len(data[0][0])
-    for i in range(1, batch_size, 1):
-        nl_a = len(data[i][0])
-        if nl_a > nl:
-            nl = nl_a
 
-    nl = nl + CONV_OFFSET
+def saveDataset(path, DS):
+    os.makedirs(path, exist_ok=True)
 
-    x = np.zeros((batch_size, nl), np.int8)
-    mx = np.zeros((batch_size, nl), np.int8)
+    np.save(os.path.join(path, "tokens.npy"), DS.tokens)
+    np.save(os.path.join(path, "offsets.npy"), DS.offsets)
+    np.save(os.path.join(path, "values.npy"), DS.values)
+    np.save(os.path.join(path, "masks.npy"), DS.masks)
 
-    z = []
-    ym = []
+    with open(os.path.join(path, "props.pkl"), "wb") as f:
+        pickle.dump([props, canon_pairs], f)
 
-    for i in range(len(props)):
-        z.append(np.zeros((batch_size, 1), np.float32))
-        ym.append(np.zeros((batch_size, 1), np.int8))
 
-    for cnt in range(batch_size):
+def loadDataset(path):
+    DS = RaggedSmiles(np.load(os.path.join(path, "tokens.npy"), mmap_mode="r"),
+                      np.load(os.path.join(path, "offsets.npy"), mmap_mode="r"),
+                      np.load(os.path.join(path, "values.npy"), mmap_mode="r"),
+                      np.load(os.path.join(path, "masks.npy"), mmap_mode="r"))
 
-        n = len(data[cnt][0])
-        for i in range(n):
-            x[cnt, i] = char_to_ix[data[cnt][0][i]]
+    with open(os.path.join(path, "props.pkl"), "rb") as f:
+        cached_props, cached_pairs = pickle.load(f)
+    props.clear()
+    props.update(cached_props)
+    canon_pairs.extend(cached_pairs)
 
-        for i, k in enumerate(range(n, nl)):
-            x[cnt, k] = x[cnt, i]
-        mx[cnt, :i + 1] = 1
+    return DS
 
-        for i in range(len(props)):
-            z[i][cnt] = data[cnt][1][i]
-            ym[i][cnt] = data[cnt][2][i]
 
-    d = [x, mx]
+def loadDescrFile(fname):
+    """analyzeDescrFile with the results kept in DATASET_CACHE for the next runs."""
+    if DATASET_CACHE == "":
+        return analyzeDescrFile(fname)
+
+    path = os.path.join(DATASET_CACHE, datasetKey(fname))
+    if os.path.exists(os.path.join(path, "props.pkl")):
+        print("Using cached dataset: ", path)
+        return loadDataset(path)
+
+    DS = analyzeDescrFile(fname)
+
+    # written under a temporary name first, so concurrent runs never see half a cache
+    tmp = path + "." + str(os.getpid())
+    saveDataset(tmp, DS)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp)
+
+    return DS
 
-    for i in range(len(props)):
-        d.extend([ym[i]])
+
+def gen_data(ds, inds, row_nl=None):
+    """Model inputs and targets for the rows inds of a RaggedSmiles.
+
+    The input mask of every row is built as if it were padded to row_nl, by default
+    the padded length of the batch itself. Rows of several batches can so go through
+    the encoder at once and still give the outputs each batch would give alone.
+    """
+    lengths = ds.lengths[inds]
+    if row_nl is None:
+        row_nl = np.full(len(inds), np.max(lengths) + CONV_OFFSET)
+    nl = np.max(row_nl)
+    k = np.arange(nl)[None, :]
+
+    # the padding repeats every string from its beginning
+    src = ds.offsets[inds][:, None] + k % np.maximum(lengths, 1)[:, None]
+    if len(ds.tokens):
+        x = np.where(lengths[:, None] > 0, ds.tokens[np.where(lengths[:, None] > 0, src, 0)], 0).astype(np.int8)
+    else:
+        # only empty strings, padded with zeros
+        x = np.zeros((len(inds), nl), dtype=np.int8)
+
+    # the mask covers the first nl - n positions, the way the models were trained
+    mx = (k < (row_nl - lengths)[:, None]).astype(np.int8)
+
+    values = np.asarray(ds.values[inds], dtype=np.float32)
+    masks = np.asarray(ds.masks[inds], dtype=np.int8)
+
+    d = [x, mx]
+    z = []
+    for i in range(masks.shape[1]):
+        d.extend([masks[:, i:i + 1]])
+        z.append(values[:, i:i + 1])
 
     return d, z
 
 
-def data_generator(ds):
-    data = []
+def makeBatches(lengths):
+    """Row indices of the batches, grouped by length if bucketing is configured.
+
+    Without bucketing the rows are taken in order, BATCH_SIZE at a time. Otherwise
+    the rows are split at the bucket boundaries and, with a token budget, sorted
+    by length and packed while the padded batch has at most BATCH_TOKENS tokens.
+    Rows of the same length keep their order, so a shuffled dataset gives new
+    batches every time; the batches themselves are returned in random order.
+    """
+    n = len(lengths)
+    if not BUCKETING:
+        return [np.arange(start, min(start + BATCH_SIZE, n)) for start in range(0, n, BATCH_SIZE)]
+
+    bucket = np.digitize(lengths, BUCKET_BOUNDARIES)
+    order = np.lexsort((lengths if BATCH_TOKENS > 0 else np.zeros(n), bucket))
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(bucket[order])) + 1, [n]])
+
+    batches = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        start = first
+        while start < last:
+            if BATCH_TOKENS > 0:
+                # lengths are sorted, so the cost of a batch grows with every row added
+                padded = lengths[order[start:min(last, start + BATCH_TOKENS // CONV_OFFSET)]] + CONV_OFFSET
+                cost = np.arange(1, len(padded) + 1) * padded
+                stop = start + max(1, np.searchsorted(cost, BATCH_TOKENS, side="right"))
+            else:
+                stop = min(last, start + BATCH_SIZE)
+            batches.append(order[start:stop])
+            start = stop
+
+    return [batches[i] for i in np.random.permutation(len(batches))]
+
+
+def encoderChunks(ds, batches):
+    """Groups consecutive batches into chunks of about ENCODER_BATCH_SIZE rows or ENCODER_BATCH_TOKENS tokens."""
+    chunk, rows, nl = [], 0, 0
+    for inds in batches:
+        rows_next = rows + len(inds)
+        nl_next = max(nl, np.max(ds.lengths[inds]) + CONV_OFFSET)
+
+        if ENCODER_BATCH_TOKENS > 0:
+            full = rows_next * nl_next > ENCODER_BATCH_TOKENS
+        else:
+            full = rows_next > ENCODER_BATCH_SIZE
+
+        if full and len(chunk):
+            yield chunk
+            chunk, rows_next, nl_next = [], len(inds), np.max(ds.lengths[inds]) + CONV_OFFSET
+
+        chunk.append(inds)
+        rows, nl = rows_next, nl_next
+
+    if len(chunk):
+        yield chunk
+
+
+def descriptor_generator(ds, encoder):
+    """Training batches of ds with the encoder outputs in place of the SMILES.
+
+    The frozen encoder runs over chunks of several training batches at once, which
+    are then sliced back into the batches. With bucketing the stored order of the
+    batches does not matter, so they are sorted by length to pad the chunks less.
+    """
+    batches = makeBatches(ds.lengths)
+    if BUCKETING:
+        batches.sort(key=lambda inds: np.max(ds.lengths[inds]))
+
+    for chunk in encoderChunks(ds, batches):
+        inds = np.concatenate(chunk)
+        row_nl = np.concatenate([np.full(len(b), np.max(ds.lengths[b]) + CONV_OFFSET) for b in chunk])
+
+        x, y = gen_data(ds, inds, row_nl)
+        z = encode(encoder, x[0], x[1], row_nl)
+
+        start = 0
+        for b in chunk:
+            rows = slice(start, start + len(b))
+            d = [z[rows, :row_nl[start]].copy()]
+            for i in range(len(props)):
+                d.extend([x[i + 2][rows]])
+            yield d, [t[rows] for t in y]
+            start += len(b)
+
+
+def applyBatches(row_nl):
+    """Row indices sorted by padded length, in batches of one length and at most ENCODER_BATCH_SIZE rows."""
+    order = np.argsort(row_nl, kind="stable")
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(row_nl[order])) + 1, [len(order)]])
+
+    batches = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        size = ENCODER_BATCH_SIZE
+        if ENCODER_BATCH_TOKENS > 0:
+            size = max(1, ENCODER_BATCH_TOKENS // row_nl[order[first]])
+        for start in range(first, last, size):
+            batches.append(order[start:min(start + size, last)])
+    return batches
+
+
+class DescriptorStore(object):
+    """Encoder outputs of the training batches in a chunked HDF5 file instead of RAM.
+
+    Behaves like the list of (inputs, targets) batches it replaces: append() writes
+    a batch to the file and indexing reads one back, as float32 whatever dtype it
+    is stored with.
+    """
+
+    def __init__(self, fname, dtype="float32"):
+        self.fname = fname
+        self.h5 = h5py.File(fname, "w")
+
+        n_props = len(props)
+        self.z = self.h5.create_dataset("descriptors", shape=(0, EMBEDDING_SIZE), maxshape=(None, EMBEDDING_SIZE),
+                                        dtype=dtype, chunks=(4096, EMBEDDING_SIZE))
+        self.masks = self.h5.create_dataset("masks", shape=(0, n_props), maxshape=(None, n_props),
+                                            dtype=np.int8, chunks=(4096, n_props))
+        self.values = self.h5.create_dataset("values", shape=(0, n_props), maxshape=(None, n_props),
+                                             dtype=np.float32, chunks=(4096, n_props))
+
+        # first descriptor row, first sample, batch size and length of every batch
+        self.batches = []
+
+    def __len__(self):
+        return len(self.batches)
+
+    def append(self, batch):
+        d, y = batch
+        b, l = d[0].shape[:2]
+        row, sample = self.z.shape[0], self.masks.shape[0]
+
+        self.z.resize(row + b * l, axis=0)
+        self.z[row:] = d[0].reshape(-1, EMBEDDING_SIZE)
+        self.masks.resize(sample + b, axis=0)
+        self.masks[sample:] = np.concatenate(d[1:], axis=1)
+        self.values.resize(sample + b, axis=0)
+        self.values[sample:] = np.concatenate(y, axis=1)
+
+        self.batches.append((row, sample, b, l))
+
+    def __getitem__(self, i):
+        row, sample, b, l = self.batches[i]
+        z = self.z[row:row + b * l].astype(np.float32).reshape(b, l, EMBEDDING_SIZE)
+        masks = self.masks[sample:sample + b]
+        values = self.values[sample:sample + b]
+
+        d = [z]
+        y = []
+        for j in range(len(props)):
+            d.append(masks[:, j:j + 1])
+            y.append(values[:, j:j + 1])
+        return d, y
+
+    def close(self):
+        self.h5.close()
+        os.remove(self.fname)
+
+
+def newDescriptors(name):
+    """An empty container for the encoder outputs, a list or a DescriptorStore if configured."""
+    if DESCRIPTOR_STORE == "":
+        return []
+
+    os.makedirs(DESCRIPTOR_STORE, exist_ok=True)
+    fname = os.path.join(DESCRIPTOR_STORE, "descriptors-" + str(os.getpid()) + "-" + name + ".h5")
+    return DescriptorStore(fname, DESCRIPTOR_DTYPE)
+
+
+def prefetch(generator, size=4):
+    """Runs the generator in a background thread, at most size items ahead of the consumer.
+
+    Errors in the generator are raised again in the consumer.
+    """
+    queue = Queue(maxsize=size)
+
+    def fill():
+        try:
+            for item in generator:
+                queue.put((True, item))
+            queue.put((False, None))
+        except BaseException as e:
+            queue.put((False, e))
+
+    threading.Thread(target=fill, daemon=True).start()
     while True:
-        for i in range(len(ds)):
-            data.append(ds[i])
-            if len(data) == BATCH_SIZE:
-                yield gen_data(data)
-                data = []
-        if len(data) > 0:
-            yield gen_data(data)
-            data = []
-        raise StopIteration()
-
-
-def buildNetwork():
+        ok, item = queue.get()
+        if not ok:
+            if item is not None:
+                raise item
+            return
+        yield item
+
+
+def fileHash(fname):
+    sha = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class EncoderCache(object):
+    """Encoder outputs of earlier runs, one HDF5 file per embeddings file (by its SHA-1 emb_hash).
+
+    The encoder is frozen, so its output for a row only depends on the weights and on
+    the row itself: the tokens and the input mask up to the padded length of the row.
+    Rows are looked up by the SHA-1 of exactly these inputs, so a hit is always the
+    output the encoder would give, whatever batch the row is in.
+    """
+
+    def __init__(self, path, emb_hash):
+        os.makedirs(path, exist_ok=True)
+
+        self.h5 = h5py.File(os.path.join(path, emb_hash + ".h5"), "a")
+        if "descriptors" not in self.h5:
+            self.h5.create_dataset("descriptors", shape=(0, EMBEDDING_SIZE), maxshape=(None, EMBEDDING_SIZE),
+                                   dtype=np.float32, chunks=(4096, EMBEDDING_SIZE))
+            self.h5.create_dataset("rows", shape=(0, 2), maxshape=(None, 2), dtype=np.int64, chunks=(4096, 2))
+
+        # the digests are raw bytes: as strings, the ones ending with NUL would be read back shortened
+        if "digests" not in self.h5:
+            # caches of earlier versions stored them as strings, the NULs stripped there are restored
+            old = [key.ljust(20, b"\0") for key in self.h5["keys"][:].tolist()] if "keys" in self.h5 else []
+            self.h5.create_dataset("digests", data=np.frombuffer(b"".join(old), dtype=np.uint8).reshape(-1, 20),
+                                   maxshape=(None, 20), chunks=(4096, 20))
+            if "keys" in self.h5:
+                del self.h5["keys"]
+
+        self.z = self.h5["descriptors"]
+        self.keys = self.h5["digests"]
+        self.rows = self.h5["rows"]
+
+        # key -> first descriptor row and length of the entry
+        self.index = dict(zip([key.tobytes() for key in self.keys[:]], self.rows[:].tolist()))
+        print("Encoder cache: ", self.h5.filename, len(self.index), "entries")
+
+    def predict(self, encoder, x, mx, row_nl):
+        z = np.zeros(x.shape + (EMBEDDING_SIZE,), dtype=np.float32)
+        keys = [hashlib.sha1(x[i, :row_nl[i]].tobytes() + mx[i, :row_nl[i]].tobytes()).digest()
+                for i in range(len(x))]
+
+        miss = np.array([i for i in range(len(x)) if keys[i] not in self.index], dtype=np.int64)
+        if len(miss):
+            nl = np.max(row_nl[miss])
+            z_miss = encoder.predict([x[miss, :nl], mx[miss, :nl]])
+
+            new_keys, new_rows, new_z = [], [], []
+            row = self.z.shape[0]
+            for j, i in enumerate(miss):
+                z[i, :row_nl[i]] = z_miss[j, :row_nl[i]]
+                if keys[i] in self.index:
+                    continue
+
+                self.index[keys[i]] = [row, row_nl[i]]
+                new_keys.append(keys[i])
+                new_rows.append([row, row_nl[i]])
+                new_z.append(z_miss[j, :row_nl[i]])
+                row += row_nl[i]
+
+            self.append(new_keys, new_rows, new_z)
+
+        computed = set(miss.tolist())
+        for i in range(len(x)):
+            if i not in computed:
+                row, length = self.index[keys[i]]
+                z[i, :length] = self.z[row:row + length]
+
+        return z
+
+    def append(self, keys, rows, z):
+        n, row = self.keys.shape[0], self.z.shape[0]
+
+        self.z.resize(row + sum(len(e) for e in z), axis=0)
+        self.z[row:] = np.concatenate(z)
+        self.keys.resize(n + len(keys), axis=0)
+        self.keys[n:] = np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(-1, 20)
+        self.rows.resize(n + len(keys), axis=0)
+        self.rows[n:] = rows
+
+        self.h5.flush()
+
+    def close(self):
+        self.h5.close()
+
+
+def openEncoderCache(emb_hash):
+    """The EncoderCache for an embeddings file if one is configured and not in use by another run."""
+    if ENCODER_CACHE == "":
+        return None
+    try:
+        return EncoderCache(ENCODER_CACHE, emb_hash)
+    except OSError as e:
+        print("Encoder cache is not available: ", e)
+        return None
+
+
+def encode(encoder, x, mx, row_nl=None):
+    """encoder.predict([x, mx]) with the outputs of earlier runs taken from the cache of the encoder."""
+    cache = encoderCaches.get(encoder)
+    if cache is None:
+        return encoder.predict([x, mx])
+    if row_nl is None:
+        row_nl = np.full(len(x), x.shape[1])
+    return cache.predict(encoder, x, mx, row_nl)
+
+
+def buildNetwork(emb_file="embeddings.npy"):
     unfreeze = False
 
     l_in = layers.Input(shape=(None,))
@@ -319,10 +801,8 @@ def buildNetwork():
     for layer in range(n_block):
 
         # self attention
-        l_o = [SelfLayer(EMBEDDING_SIZE, KEY_SIZE, trainable=unfreeze)([l_embed, l_embed, l_embed, l_left_mask]) for i
-               in range(n_self)]
-
-        l_con = layers.Concatenate()(l_o)
+        l_con = MultiHeadSelfLayer(EMBEDDING_SIZE, KEY_SIZE, n_self,
+                                   trainable=unfreeze)([l_embed, l_embed, l_embed, l_left_mask])
         l_dense = layers.TimeDistributed(layers.Dense(EMBEDDING_SIZE, trainable=unfreeze), trainable=unfreeze)(l_con)
         if unfreeze == True: l_dense = layers.Dropout(rate=0.1)(l_dense)
         l_add = layers.Add()([l_dense, l_embed])
@@ -411,7 +891,7 @@ def buildNetwork():
     # so far we do not train the encoder part of the model.
     encoder = tf.keras.Model([l_in, l_mask], l_encoder)
     encoder.compile(optimizer='adam', loss='mse')
-    encoder.set_weights(np.load("embeddings.npy", allow_pickle=True))
+    encoder.set_weights(np.load(emb_file, allow_pickle=True))
 
     # encoder.summary()
 
@@ -445,9 +925,7 @@ def Smi2Smi():
 
     for layer in range(n_block):
         # self attention
-        l_o = [SelfLayer(EMBEDDING_SIZE, KEY_SIZE)([l_embed, l_embed, l_embed, l_left_mask]) for i in range(n_self)]
-
-        l_con = layers.Concatenate()(l_o)
+        l_con = MultiHeadSelfLayer(EMBEDDING_SIZE, KEY_SIZE, n_self)([l_embed, l_embed, l_embed, l_left_mask])
         l_dense = layers.TimeDistributed(layers.Dense(EMBEDDING_SIZE))(l_con)
         l_drop = layers.Dropout(rate=0.1)(l_dense)
         l_add = layers.Add()([l_drop, l_embed])
@@ -468,17 +946,14 @@ def Smi2Smi():
 
     for layer in range(n_block):
         # self attention
-        l_o = [SelfLayer(EMBEDDING_SIZE, KEY_SIZE)([l_embed, l_embed, l_embed, l_right_mask]) for i in range(n_self)]
-
-        l_con = layers.Concatenate()(l_o)
+        l_con = MultiHeadSelfLayer(EMBEDDING_SIZE, KEY_SIZE, n_self)([l_embed, l_embed, l_embed, l_right_mask])
         l_dense = layers.TimeDistributed(layers.Dense(EMBEDDING_SIZE))(l_con)
         l_drop = layers.Dropout(rate=0.1)(l_dense)
         l_add = layers.Add()([l_drop, l_embed])
         l_att = LayerNormalization()(l_add)
 
         # attention to the encoder
-        l_o = [SelfLayer(EMBEDDING_SIZE, KEY_SIZE)([l_att, l_encoder, l_encoder, l_emask]) for i in range(n_self)]
-        l_con = layers.Concatenate()(l_o)
+        l_con = MultiHeadSelfLayer(EMBEDDING_SIZE, KEY_SIZE, n_self)([l_att, l_encoder, l_encoder, l_emask])
         l_dense = layers.TimeDistributed(layers.Dense(EMBEDDING_SIZE))(l_con)
         l_drop = layers.Dropout(rate=0.1)(l_dense)
         l_add = layers.Add()([l_drop, l_att])
@@ -573,6 +1048,493 @@ def smi_gen_data(data):
     return [x, mx, y, my], z
 
 
+def readMolecules(fname, start=0, stop=None):
+    """SMILES of the rows between the byte offsets start and stop, which are at line starts."""
+    with open(fname, "rb") as f:
+        f.seek(start)
+
+        def lines():
+            pos = start
+            for line in f:
+                if stop is not None and pos >= stop:
+                    return
+                pos += len(line)
+                yield line.decode()
+
+        for row in csv.reader(lines()):
+            yield row[0]
+
+
+def dataStart(fname):
+    """Byte offset of the first data row, after the header line if there is one."""
+    with open(fname, "rb") as f:
+        if FIRST_LINE:
+            f.readline()
+        return f.tell()
+
+
+def splitFile(fname, n, align=1):
+    """n byte ranges of about the same size at line starts, with the index of their first row.
+
+    Every range but the first starts at a row index that is a multiple of align.
+    """
+    size = os.path.getsize(fname)
+    first = dataStart(fname)
+
+    bounds, rows = [first], [0]
+    with open(fname, "rb") as f:
+        f.seek(first)
+        pos, row, last = first, 0, b"\n"
+
+        for i in range(1, n):
+            target = first + (size - first) * i // n
+            while pos < target:
+                block = f.read(min(target - pos, 1 << 24))
+                row += block.count(b"\n")
+                pos += len(block)
+                last = block[-1:]
+
+            # the rest of the line, then whole lines up to the alignment
+            if last != b"\n":
+                line = f.readline()
+                row, pos, last = row + 1, pos + len(line), b"\n"
+            while row % align != 0 and pos < size:
+                pos += len(f.readline())
+                row += 1
+
+            bounds.append(pos)
+            rows.append(row)
+
+    bounds.append(size)
+    return [(i, bounds[i], bounds[i + 1], rows[i]) for i in range(n)]
+
+
+def inferenceOutputs(encoder, mdls):
+    """Outputs of all the models computed from the encoder in one graph.
+
+    The property masks are only used by the training losses, so the heads are taken
+    without them, and the encoder output stays in the graph instead of going through NumPy.
+    """
+    outputs = []
+    for mdl in mdls:
+        head = tf.keras.Model(mdl.inputs[0], mdl.outputs)
+        out = head(encoder.outputs[0])
+        outputs.extend(out if isinstance(out, list) else [out])
+    return outputs
+
+
+def inferenceFunction(encoder, mdls):
+    return K.function(encoder.inputs, inferenceOutputs(encoder, mdls))
+
+
+def exportInference(mdl, encoder):
+    """The inference graph of a model with the weights folded into constants, and its input and output names."""
+    outputs = inferenceOutputs(encoder, [mdl])
+
+    sess = K.get_session()
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(),
+                                                             [t.op.name for t in outputs])
+
+    return graph_def.SerializeToString(), [t.name for t in encoder.inputs], [t.name for t in outputs]
+
+
+def inferenceMembers(mdl, encoder):
+    """The inference.pb and inference.pkl members of the model bundle."""
+    graph, inputs, outputs = exportInference(mdl, encoder)
+    return {"inference.pb": graph, "inference.pkl": pickle.dumps([inputs, outputs])}
+
+
+class FrozenModel(object):
+    """The exported inference graph of a bundle, run without building the model in Python."""
+
+    def __init__(self, graph, inputs, outputs, scope):
+        graph_def = tf.GraphDef()
+        graph_def.ParseFromString(graph)
+
+        sess = K.get_session()
+        with sess.graph.as_default():
+            tf.import_graph_def(graph_def, name=scope)
+
+        self.inputs = [sess.graph.get_tensor_by_name(scope + "/" + name) for name in inputs]
+        self.outputs = [sess.graph.get_tensor_by_name(scope + "/" + name) for name in outputs]
+        self.run = sess.make_callable(self.outputs, feed_list=self.inputs)
+
+    def __call__(self, xs):
+        return self.run(*[x.astype(np.float32) for x in xs])
+
+
+class ModelBundle(object):
+    """The members of a model bundle, read into memory without extracting the archive.
+
+    Nothing is written to disk, so any number of processes can load the same bundle at once.
+    Bundles are written as uncompressed tar files; gzip bundles of earlier versions are read the same way.
+    """
+
+    def __init__(self, fname):
+        with tarfile.open(fname) as tar:
+            self.members = {m.name: tar.extractfile(m).read() for m in tar.getmembers() if m.isfile()}
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def read(self, name):
+        return self.members[name]
+
+    def open(self, name):
+        return io.BytesIO(self.members[name])
+
+
+def writeBundle(fname, members):
+    """Writes the members, a dict of name -> bytes, as an uncompressed model bundle.
+
+    The bundle is replaced with a rename, so a process loading it never sees a partial file.
+    """
+    with tarfile.open(fname + ".tmp", "w") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    os.rename(fname + ".tmp", fname)
+
+
+# layers of older weights files and the layers that replaced them
+legacy_layers = {"self_layer": "multi_head_self_layer"}
+
+
+def layerKey(name):
+    """The type and creation index of a layer from its name, e.g. conv1d_3."""
+    base, _, index = name.rpartition("_")
+    if base and index.isdigit():
+        return base, int(index)
+    return name, 0
+
+
+def loadWeights(mdl, f):
+    """mdl.load_weights for an HDF5 weights file, given by name or as a file object.
+
+    Keras matches the layers of the file by their order in the graph, which changes with the
+    structure of the model. Here the layers of every type are matched in the order they were
+    created, so the heads of the SelfLayers of older files load into the MultiHeadSelfLayers.
+    """
+    with h5py.File(f, "r") as h5:
+        saved = {}
+        for name in h5.attrs["layer_names"]:
+            group = h5[name]
+            if len(group.attrs["weight_names"]):
+                base, index = layerKey(name.decode("utf8") if isinstance(name, bytes) else name)
+                saved.setdefault(legacy_layers.get(base, base), []).append(
+                    (index, [np.asarray(group[w]) for w in group.attrs["weight_names"]]))
+
+    built = {}
+    for layer in mdl.layers:
+        if layer.weights:
+            base, index = layerKey(layer.name)
+            built.setdefault(base, []).append((index, layer.weights))
+
+    if sorted(saved) != sorted(built):
+        raise ValueError("The layers of the weights file " + str(sorted(saved)) +
+                         " do not match the model " + str(sorted(built)))
+
+    values = []
+    for base in built:
+        weights = [w for _, ws in sorted(built[base], key=lambda e: e[0]) for w in ws]
+        stored = [v for _, vs in sorted(saved[base], key=lambda e: e[0]) for v in vs]
+        if len(weights) != len(stored) or \
+                any(tuple(w.shape.as_list()) != v.shape for w, v in zip(weights, stored)):
+            raise ValueError("The weights of " + base + " do not match the model")
+        values.extend(zip(weights, stored))
+    K.batch_set_value(values)
+
+
+def bundleProps(fname):
+    with tarfile.open(fname) as tar:
+        return pickle.load(tar.extractfile("model.pkl"))
+
+
+def outputColumns(fnames):
+    """Properties and names of the output columns of the bundles, and the columns of every ensemble.
+
+    With several bundles every property name predicted by more than one of them
+    gets the mean and standard deviation over these models as extra columns.
+    """
+    columns, names, by_name = [], [], {}
+    for fname in fnames:
+        model_props = bundleProps(fname)
+        for prop in model_props:
+            name = model_props[prop][1]
+            by_name.setdefault(name, []).append(len(columns))
+            columns.append(model_props[prop])
+            names.append(name if len(fnames) == 1 else os.path.basename(fname) + ":" + name)
+
+    ensemble = [(name, cols) for name, cols in by_name.items() if len(cols) > 1]
+    for name, cols in ensemble:
+        names.extend([name + ":mean", name + ":std"])
+
+    return columns, names, ensemble
+
+
+class ModelSet(object):
+    """The models of one or more bundles, applied as one.
+
+    The encoders are frozen, so bundles with the same embeddings file share one
+    encoder: every batch goes through it once and its output through all their heads.
+    A bundle with an exported inference graph that shares its encoder with no other
+    bundle is run from that graph instead of building its model.
+    """
+
+    def __init__(self, fnames):
+        self.columns, self.names, self.ensemble = outputColumns(fnames)
+
+        bundles = [ModelBundle(fname) for fname in fnames]
+        hashes = [hashlib.sha1(bundle.read("embeddings.npy")).hexdigest() for bundle in bundles]
+
+        # [encoder, [(model, first column, number of columns)], fused inference function or None]
+        self.groups = []
+        groups = {}
+        first = 0
+
+        for i, bundle in enumerate(bundles):
+            # buildNetwork makes one output for every property in props
+            props.clear()
+            props.update(pickle.loads(bundle.read("model.pkl")))
+
+            if hashes.count(hashes[i]) == 1 and ENCODER_CACHE == "" and "inference.pb" in bundle:
+                inputs, outputs = pickle.loads(bundle.read("inference.pkl"))
+                frozen = FrozenModel(bundle.read("inference.pb"), inputs, outputs, "frozen_" + str(i))
+                self.groups.append([None, [(None, first, len(props))], frozen])
+                first += len(props)
+                continue
+
+            mdl, encoder = buildNetwork(bundle.open("embeddings.npy"))
+            loadWeights(mdl, bundle.open("model.h5"))
+
+            if hashes[i] not in groups:
+                groups[hashes[i]] = len(self.groups)
+                self.groups.append([encoder, []])
+                encoderCaches[encoder] = openEncoderCache(hashes[i])
+
+            self.groups[groups[hashes[i]]][1].append((mdl, first, len(props)))
+            first += len(props)
+
+        # with an encoder cache the encoder outputs are needed in NumPy
+        for group in self.groups:
+            if len(group) == 3:
+                continue
+
+            encoder, heads = group
+            fused = None
+            if encoderCaches.get(encoder) is None:
+                fused = inferenceFunction(encoder, [mdl for mdl, _, _ in heads])
+            group.append(fused)
+
+        print("Models: ", len(fnames), "encoders: ", len(self.groups))
+
+    def predict(self, ds, inds, row_nl=None):
+        """Predictions for the rows inds of a RaggedSmiles as an array of one column per output."""
+        x, _ = gen_data(ds, inds, row_nl)
+
+        y = np.zeros((len(inds), len(self.columns)), dtype=np.float32)
+        for encoder, heads, fused in self.groups:
+            if fused is not None:
+                out = fused([x[0], x[1]])
+                for mdl, first, n in heads:
+                    y[:, first:first + n] = np.concatenate(out[:n], axis=1)
+                    out = out[n:]
+                continue
+
+            internal = encode(encoder, x[0], x[1], row_nl)
+
+            for mdl, first, n in heads:
+                p = [internal]
+                for i in range(n):
+                    p.extend([np.ones((len(inds), 1), dtype=np.int8)])
+
+                out = mdl.predict(p)
+                if n == 1:
+                    out = [out]
+                y[:, first:first + n] = np.concatenate(out, axis=1)
+
+        return y
+
+
+def smilesData(arr):
+    """Tokenized SMILES for the prognosis; the models get their property masks in predict."""
+    return RaggedSmiles.fromStrings(arr, np.zeros((len(arr), 0), dtype=np.float32),
+                                    np.zeros((len(arr), 0), dtype=np.int8))
+
+
+def prepareMolecules(pool, start, mols):
+    """Tokenized random SMILES of the molecules and the molecule every string belongs to."""
+    jobs = list(enumerate(mols, start))
+    if pool is None:
+        with suppress_stderr():
+            augmented = [applySmiles(job) for job in jobs]
+    else:
+        augmented = pool.map(applySmiles, jobs, chunksize=max(1, len(jobs) // (4 * NUM_WORKERS)))
+
+    arr, owner = [], []
+    for i, smiles in enumerate(augmented):
+        arr.extend(smiles)
+        owner.extend([i] * len(smiles))
+
+    ds, valid = smilesData(arr)
+    return len(mols), ds, np.array(owner, dtype=np.int64)[valid]
+
+
+def predictMolecules(models, n, ds, owner):
+    """Mean prediction over the random SMILES of every molecule, in input order.
+
+    The SMILES of all molecules go through the model together, sorted by length. Every
+    string is still padded and masked as if its molecule was predicted on its own.
+    """
+    counts = np.bincount(owner, minlength=n)
+    res = np.zeros((n, len(models.columns)))
+
+    if len(ds):
+        mol_nl = np.zeros(n, dtype=np.int64)
+        np.maximum.at(mol_nl, owner, ds.lengths)
+        row_nl = mol_nl[owner] + CONV_OFFSET
+
+        y = np.zeros((len(ds), len(models.columns)), dtype=np.float32)
+        for inds in applyBatches(row_nl):
+            y[inds] = models.predict(ds, inds, row_nl[inds])
+
+        for c in range(len(models.columns)):
+            res[:, c] = np.bincount(owner, weights=y[:, c], minlength=n) / np.maximum(counts, 1)
+
+    return res, counts
+
+
+def predictBatch(models, arr):
+    """Predictions for a batch of SMILES strings padded together, as they are without canonization."""
+    ds, valid = smilesData(arr)
+
+    res = np.zeros((len(arr), len(models.columns)), dtype=np.float32)
+    if len(ds):
+        res[valid] = models.predict(ds, np.arange(len(ds)))
+    return res, valid.astype(np.int64)
+
+
+def writeResults(fp, models, res, counts):
+    for i in range(len(res)):
+        if counts[i] == 0:
+            for name in models.names:
+                print("error", end=",", file=fp)
+            print("", file=fp)
+            continue
+
+        vals = []
+        for c, prop in enumerate(models.columns):
+            val = res[i, c]
+            if prop[2] == "regression":
+                val = (val - 0.9) / 0.8 * (prop[4] - prop[3]) + prop[4]
+            vals.append(val)
+            print(val, end=",", file=fp)
+
+        for name, cols in models.ensemble:
+            print(np.mean([vals[c] for c in cols]), end=",", file=fp)
+            print(np.std([vals[c] for c in cols]), end=",", file=fp)
+        print("", file=fp)
+
+
+def applyFile(models, pool, molecules, first, fp):
+    """Writes the predictions for the SMILES from molecules, the first of them at row first of the input."""
+    if CANONIZE == 'True':
+        # RDKit work-up in the workers, model inference here and writing of the results
+        # run at the same time, connected by bounded queues
+        def preparedChunks():
+            mols, start = [], first
+            for mol in molecules:
+                mols.append(mol)
+                if len(mols) == APPLY_CHUNK:
+                    yield prepareMolecules(pool, start, mols)
+                    mols, start = [], start + len(mols)
+
+            if len(mols):
+                yield prepareMolecules(pool, start, mols)
+
+        def writer():
+            try:
+                for res, counts in iter(results.get, None):
+                    writeResults(fp, models, res, counts)
+            except BaseException as e:
+                # raised again here, the rest is taken off the queue so that put() does not block
+                failed.append(e)
+                for _ in iter(results.get, None):
+                    pass
+
+        results = Queue(maxsize=2)
+        failed = []
+        thread = threading.Thread(target=writer)
+        thread.start()
+
+        try:
+            for n, ds, owner in prefetch(preparedChunks(), 2):
+                if failed:
+                    break
+                results.put(predictMolecules(models, n, ds, owner))
+        finally:
+            results.put(None)
+            thread.join()
+
+        if failed:
+            raise failed[0]
+
+    else:
+        arr = []
+        for mol in molecules:
+            arr.append(mol)
+            if len(arr) == BATCH_SIZE:
+                writeResults(fp, models, *predictBatch(models, arr))
+                arr = []
+
+        if len(arr):
+            writeResults(fp, models, *predictBatch(models, arr))
+
+
+def rdkitPool(workers):
+    """The RDKit workers of the canonize mode, forked before the model is built."""
+    if CANONIZE != 'True':
+        return None
+    if workers > 1:
+        return multiprocessing.get_context("fork").Pool(workers, initializer=initWorker)
+    initWorker(False)
+    return None
+
+
+def closeEncoderCaches():
+    for cache in encoderCaches.values():
+        if cache is not None:
+            cache.close()
+    encoderCaches.clear()
+
+
+def shardFile(index):
+    return RESULT_FILE + ".shard-" + str(index) + "-of-" + str(N_SHARDS)
+
+
+def applyShard(shard):
+    """Applies the models to one byte range of APPLY_FILE, in a process of its own."""
+    index, start, stop, first = shard
+
+    # the cores are shared between the shards
+    global NUM_WORKERS
+    NUM_WORKERS = max(1, NUM_WORKERS // N_SHARDS)
+    pool = rdkitPool(NUM_WORKERS)
+
+    models = ModelSet(MODEL_FILES)
+
+    # a shard is only complete after the rename, so a restarted run redoes just the missing ones
+    with open(shardFile(index) + ".part", "w") as fp:
+        applyFile(models, pool, readMolecules(APPLY_FILE, start, stop), first, fp)
+    os.rename(shardFile(index) + ".part", shardFile(index))
+
+    if pool is not None:
+        pool.close()
+    closeEncoderCaches()
+
+
 if __name__ == "__main__":
 
     device_str = "GPU" + str(DEVICE)
@@ -580,7 +1542,10 @@ if __name__ == "__main__":
     if TRAIN == "True":
         print("Analyze training file...")
 
-        DS = analyzeDescrFile(TRAIN_FILE)
+        DS = loadDescrFile(TRAIN_FILE)
+
+        # the intermediate files of the run, so that runs in the same directory do not overwrite each other
+        work = tempfile.mkdtemp(prefix="train-", dir=".")
 
         if len(canon_pairs) > 0:
             random.shuffle(canon_pairs)
@@ -588,9 +1553,9 @@ if __name__ == "__main__":
             smi2smi, smi_encoder = Smi2Smi()
 
             if CHIRALITY == "True":
-                smi2smi.load_weights("pretrained/canonization.h5")
+                loadWeights(smi2smi, "pretrained/canonization.h5")
             else:
-                smi2smi.load_weights("pretrained/canonization-nochiral.h5")
+                loadWeights(smi2smi, "pretrained/canonization-nochiral.h5")
 
             epochs_to_save = [6, 7, 8, 9]
             smi_batch = 32
@@ -609,7 +1574,7 @@ if __name__ == "__main__":
 
                 def on_epoch_end(self, epoch, logs={}):
                     if epoch in epochs_to_save:
-                        smi2smi.save_weights("tr-" + str(epoch) + ".h5", save_format="h5")
+                        smi2smi.save_weights(os.path.join(work, "tr-" + str(epoch) + ".h5"), save_format="h5")
 
 
             def smi2smi_generator():
@@ -634,7 +1599,7 @@ if __name__ == "__main__":
             f = []
 
             for i in epochs_to_save:
-                f.append(h5py.File("tr-" + str(i) + ".h5", "r+"))
+                f.append(h5py.File(os.path.join(work, "tr-" + str(i) + ".h5"), "r+"))
 
             keys = list(f[0].keys())
             for key in keys:
@@ -653,24 +1618,24 @@ if __name__ == "__main__":
                 fp.close()
 
             for i in epochs_to_save[1:]:
-                os.remove("tr-" + str(i) + ".h5")
-            os.rename("tr-" + str(epochs_to_save[0]) + ".h5", "final.h5")
+                os.remove(os.path.join(work, "tr-" + str(i) + ".h5"))
 
             # extract embeddings
-            smi2smi.load_weights("final.h5")
+            smi2smi.load_weights(os.path.join(work, "tr-" + str(epochs_to_save[0]) + ".h5"))
             w = smi_encoder.get_weights()
-            np.save("embeddings.npy", w)
-            os.remove("final.h5")
+            emb_fname = os.path.join(work, "embeddings.npy")
+            np.save(emb_fname, w)
 
         else:
             if CHIRALITY == "True":
-                shutil.copy("pretrained/embeddings.npy", "embeddings.npy")
+                emb_fname = "pretrained/embeddings.npy"
             else:
-                shutil.copy("pretrained/embeddings-nochiral.npy", "embeddings.npy")
+                emb_fname = "pretrained/embeddings-nochiral.npy"
 
         # end of pretraining
 
-        mdl, encoder = buildNetwork()
+        mdl, encoder = buildNetwork(emb_fname)
+        encoderCaches[encoder] = openEncoderCache(fileHash(emb_fname))
 
         nall = len(DS)
         print("Number of all points: ", nall)
@@ -678,23 +1643,31 @@ if __name__ == "__main__":
         inds = np.arange(nall)
 
 
-        def data_generator2(dsc):
+        def storedBatches(dsc):
             while True:
-                for i in range(len(dsc)):
-                    yield dsc[i][0], dsc[i][1]
+                # with bucketing the batches are sorted by length, so take them in a new order every epoch
+                order = np.random.permutation(len(dsc)) if BUCKETING else range(len(dsc))
+                for i in order:
+                    yield dsc[i]
 
 
-        if EARLY_STOPPING == 0:
-            np.random.shuffle(inds)
+        def data_generator2(dsc):
+            # batches on disk are read ahead while the model trains on the current one
+            if isinstance(dsc, DescriptorStore):
+                return prefetch(storedBatches(dsc))
+            return storedBatches(dsc)
+
 
-            d = [DS[x] for x in inds]
-            all_generator = data_generator(d)
+        def calcDescriptors(ds, dsc):
+            for d, y in descriptor_generator(ds, encoder):
+                dsc.append((d, y))
+            return dsc
 
-            DSC_ALL = []
-            for x, y in all_generator:
-                z = encoder.predict(x)
-                DSC_ALL.append((z, y))
 
+        if EARLY_STOPPING == 0:
+            np.random.shuffle(inds)
+
+            DSC_ALL = calcDescriptors(DS.subset(inds), newDescriptors("all"))
             all_generator = data_generator2(DSC_ALL)
 
         else:
@@ -705,30 +1678,9 @@ if __name__ == "__main__":
             inds_train = inds[:ntrain]
             inds_valid = inds[ntrain:]
 
-            DS_train = [DS[x] for x in inds_train]
-            DS_valid = [DS[x] for x in inds_valid]
-
-            train_generator = data_generator(DS_train)
-            valid_generator = data_generator(DS_valid)
-
-            DSC_TRAIN = []
-            DSC_VALID = []
-
             # calculate "descriptors"
-            for x, y in train_generator:
-
-                z = encoder.predict([x[0], x[1]])
-                d = [z]
-                for i in range(len(props)):
-                    d.extend([x[i + 2]])
-                DSC_TRAIN.append((d, y))
-
-            for x, y in valid_generator:
-                z = encoder.predict([x[0], x[1]])
-                d = [z]
-                for i in range(len(props)):
-                    d.extend([x[i + 2]])
-                DSC_VALID.append((d, y))
+            DSC_TRAIN = calcDescriptors(DS.subset(inds_train), newDescriptors("train"))
+            DSC_VALID = calcDescriptors(DS.subset(inds_valid), newDescriptors("valid"))
 
             train_generator = data_generator2(DSC_TRAIN)
             valid_generator = data_generator2(DSC_VALID)
@@ -780,7 +1732,7 @@ if __name__ == "__main__":
                                                                                epoch + 1, device_str))
 
                 if EARLY_STOPPING == 0 and epoch >= (NUM_EPOCHS - AVERAGING - 1):
-                    self.model.save_weights("e-" + str(epoch) + ".h5")
+                    self.model.save_weights(os.path.join(work, "e-" + str(epoch) + ".h5"))
 
                 if os.path.exists("stop"):
                     self.model.stop_training = True
@@ -796,13 +1748,13 @@ if __name__ == "__main__":
                                         use_multiprocessing=False,
                                         shuffle=True,
                                         verbose=0,
-                                        callbacks=[ModelCheckpoint("model/", monitor='val_loss',
+                                        callbacks=[ModelCheckpoint(os.path.join(work, "model", ""), monitor='val_loss',
                                                                    save_best_only=True, save_weights_only=True,
                                                                    mode='auto', period=1),
                                                    MessagerCallback()])
 
-            mdl.load_weights("model/")  # restoring best saved model
-            mdl.save_weights("model.h5")
+            mdl.load_weights(os.path.join(work, "model", ""))  # restoring best saved model
+            mdl.save_weights(os.path.join(work, "model.h5"))
 
         else:
             history = mdl.fit_generator(generator=all_generator,
@@ -817,7 +1769,7 @@ if __name__ == "__main__":
             f = []
 
             for i in range(NUM_EPOCHS - AVERAGING - 1, NUM_EPOCHS):
-                f.append(h5py.File("e-" + str(i) + ".h5", "r+"))
+                f.append(h5py.File(os.path.join(work, "e-" + str(i) + ".h5"), "r+"))
 
             keys = list(f[0].keys())
             for key in keys:
@@ -836,204 +1788,79 @@ if __name__ == "__main__":
                 fp.close()
 
             for i in range(NUM_EPOCHS - AVERAGING, NUM_EPOCHS):
-                os.remove("e-" + str(i) + ".h5")
-            os.rename("e-" + str(NUM_EPOCHS - AVERAGING - 1) + ".h5", "model.h5")
+                os.remove(os.path.join(work, "e-" + str(i) + ".h5"))
+            os.rename(os.path.join(work, "e-" + str(NUM_EPOCHS - AVERAGING - 1) + ".h5"),
+                      os.path.join(work, "model.h5"))
 
-        with open('model.pkl', 'wb') as f:
-            pickle.dump(props, f)
+        for dsc in [DSC_TRAIN, DSC_VALID] if EARLY_STOPPING > 0 else [DSC_ALL]:
+            if isinstance(dsc, DescriptorStore):
+                dsc.close()
 
-        tar = tarfile.open(MODEL_FILE, "w:gz")
-        tar.add("model.pkl")
-        tar.add("model.h5")
-        tar.add("embeddings.npy")
-        tar.close()
+        # the final weights, e.g. averaged over the last epochs, go into the inference graph
+        mdl.load_weights(os.path.join(work, "model.h5"))
 
-        if EARLY_STOPPING > 0:
-            shutil.rmtree("model/")
+        members = {"model.pkl": pickle.dumps(props)}
+        for name, fname in [("model.h5", os.path.join(work, "model.h5")), ("embeddings.npy", emb_fname)]:
+            with open(fname, "rb") as f:
+                members[name] = f.read()
+        members.update(inferenceMembers(mdl, encoder))
+        writeBundle(MODEL_FILE, members)
 
-        os.remove("model.pkl")
-        os.remove("model.h5")
-        os.remove("embeddings.npy")
+        shutil.rmtree(work)
 
-    elif TRAIN == "False":
+    elif TRAIN == "Export":
 
-        tar = tarfile.open(MODEL_FILE)
-        tar.extractall()
-        tar.close()
+        # adds the inference graph to a bundle trained before it was written by default,
+        # and rewrites a gzip bundle uncompressed
+        bundle = ModelBundle(MODEL_FILE)
+        props = pickle.loads(bundle.read("model.pkl"))
 
-        props = pickle.load(open("model.pkl", "rb"))
+        mdl, encoder = buildNetwork(bundle.open("embeddings.npy"))
+        loadWeights(mdl, bundle.open("model.h5"))
 
-        mdl, encoder = buildNetwork()
-        mdl.load_weights("model.h5")
+        members = dict(bundle.members)
+        members.update(inferenceMembers(mdl, encoder))
+        writeBundle(MODEL_FILE, members)
 
-        first_row = FIRST_LINE
-        DS = []
+    elif TRAIN == "False":
+
+        # model_file may list several bundles, they are applied together
+        columns, names, ensemble = outputColumns(MODEL_FILES)
 
         fp = open(RESULT_FILE, "w")
-        for prop in props:
-            print(props[prop][1], end=",", file=fp)
+        for name in names:
+            print(name, end=",", file=fp)
         print("", file=fp)
 
-        ind_mol = 0
-
-        if CANONIZE == 'True':
-            remover = SaltRemover.SaltRemover()
-            for row in csv.reader(open(APPLY_FILE, "r")):
-                if first_row:
-                    first_row = False
-                    continue
-
-                mol = row[ind_mol]
-                g_mol = set(mol)
-                g_left = g_mol - g_chars
+        if N_SHARDS > 1:
+            # every shard is written by a new process with its own model, then they are joined in order
+            # without canonization a prediction depends on the batch, so the shards start at batch boundaries
+            shards = splitFile(APPLY_FILE, N_SHARDS, 1 if CANONIZE == 'True' else BATCH_SIZE)
+            shards = [shard for shard in shards if not os.path.exists(shardFile(shard[0]))]
+            if len(shards) < N_SHARDS:
+                print("Resuming, shards left: ", len(shards))
 
-                arr = []
-                if len(g_left) == 0:
-                    try:
-                        with suppress_stderr():
-                            m = MolFromSmiles(mol)
-                            m = remover.StripMol(m)
-                            if m is not None and m.GetNumAtoms() > 0:
-                                for step in range(10):
-                                    arr.append(MolToSmiles(m, rootedAtAtom=np.random.randint(0, m.GetNumAtoms()),
-                                                                canonical=False))
-                            else:
-                                arr.append(mol)
-                    except:
-                        arr.append(mol)
-                else:
-                    for i in range(len(props)):
-                        print("error", end=",", file=fp)
+            if len(shards):
+                with multiprocessing.get_context("spawn").Pool(len(shards)) as shard_pool:
+                    shard_pool.map(applyShard, shards, chunksize=1)
 
-                z = np.zeros(len(props), dtype=np.float32)
-                ymask = np.ones(len(props), dtype=np.int8)
-
-                d = []
-                for i in range(len(arr)):
-                    d.append([arr[i], z, ymask])
-
-                x, y = gen_data(d)
-                internal = encoder.predict([x[0], x[1]])
-
-                p = [internal]
-                for i in range(len(props)):
-                    p.extend([x[i + 2]])
-
-                y = mdl.predict(p)
-                res = np.zeros(len(props))
-
-                for prop in props:
-                    if len(props) == 1:
-                        res[prop] = np.mean(y)
-                    else:
-                        res[prop] = np.mean(y[prop])
-                    if props[prop][2] == "regression":
-                        res[prop] = (res[prop] - 0.9) / 0.8 * (props[prop][4] - props[prop][3]) + props[prop][4]
-                    print(res[prop], end=",", file=fp)
-                print("", file=fp)
+            for index in range(N_SHARDS):
+                with open(shardFile(index), "r") as f:
+                    shutil.copyfileobj(f, fp)
+            for index in range(N_SHARDS):
+                os.remove(shardFile(index))
 
         else:
+            pool = rdkitPool(NUM_WORKERS)
+            models = ModelSet(MODEL_FILES)
 
-            arr = []
-            e = []
-
-            for row in csv.reader(open(APPLY_FILE, "r")):
-                if first_row:
-                    first_row = False
-                    continue
-
-                mol = row[ind_mol]
-                g_mol = set(mol)
-                g_left = g_mol - g_chars
-
-                if len(g_left) == 0:
-                    e.append(1)
-                    arr.append(mol)
-                else:
-                    e.append(0)
-                    arr.append("CC")
-
-                if (len(arr) == BATCH_SIZE):
-
-                    z = np.zeros(len(props), dtype=np.float32)
-                    ymask = np.ones(len(props), dtype=np.int8)
-
-                    d = []
-                    for i in range(len(arr)):
-                        d.append([arr[i], z, ymask])
-
-                    x, y = gen_data(d)
-                    internal = encoder.predict([x[0], x[1]])
-
-                    p = [internal]
-                    for i in range(len(props)):
-                        p.extend([x[i + 2]])
-
-                    y = mdl.predict(p)
-                    res = np.zeros(len(props))
-
-                    for i in range(len(arr)):
-                        if e[i] == 0:
-                            for prop in props:
-                                print("error", end=",", file=fp)
-                            print("", file=fp)
-                            continue
-
-                        for prop in props:
-                            if len(props) == 1:
-                                res = y[i][prop]
-                            else:
-                                res = y[prop][i][0]
-
-                            if props[prop][2] == "regression":
-                                res = (res - 0.9) / 0.8 * (props[prop][4] - props[prop][3]) + props[prop][4]
-                            print(res, end=",", file=fp)
-                        print("", file=fp)
-
-                    arr = []
-                    e = []
-
-            if len(arr):
-
-                z = np.zeros(len(props), dtype=np.float32)
-                ymask = np.ones(len(props), dtype=np.int8)
-
-                d = []
-                for i in range(len(arr)):
-                    d.append([arr[i], z, ymask])
-
-                x, y = gen_data(d)
-                internal = encoder.predict([x[0], x[1]])
-
-                p = [internal]
-                for i in range(len(props)):
-                    p.extend([x[i + 2]])
-
-                y = mdl.predict(p)
-                res = np.zeros(len(props))
-
-                for i in range(len(arr)):
-                    if e[i] == 0:
-                        for prop in props:
-                            print("error", end=",", file=fp)
-                        print("", file=fp)
-                        continue
-
-                    for prop in props:
-                        if len(props) == 1:
-                            res = y[i][prop]
-                        else:
-                            res = y[prop][i][0]
+            applyFile(models, pool, readMolecules(APPLY_FILE, dataStart(APPLY_FILE)), 0, fp)
 
-                        if props[prop][2] == "regression":
-                            res = (res - 0.9) / 0.8 * (props[prop][4] - props[prop][3]) + props[prop][4]
-                        print(res, end=",", file=fp)
-                    print("", file=fp)
+            if pool is not None:
+                pool.close()
 
         fp.close()
 
-        os.remove("model.pkl")
-        os.remove("model.h5")
-        os.remove("embeddings.npy")
+    closeEncoderCaches()
 
     print("Relax!")